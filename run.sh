@@ -39,7 +39,7 @@ fi
 
 # 安装Python依赖
 echo -e "${YELLOW}安装Python依赖...${NC}"
-pip install flask==2.3.3 flask-cors==4.0.0 mcp==0.2.0 requests==2.31.0
+pip install -r server/requirements.txt
 
 # 检查hello.py是否可用
 if [ -f "server/mcp-server-demo/hello.py" ]; then
@@ -3,48 +3,164 @@ from fastapi import FastAPI, HTTPException, WebSocket, Request
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.responses import StreamingResponse
 from pydantic import BaseModel
-import json
+import orjson
 import asyncio
 from typing import Dict, Any, Optional, List
-from main import Configuration, create_server, LLMClient, ChatSession, initialize_system
+from main import Configuration, create_server, LLMClient, ChatSession, initialize_system, build_system_message
 import logging
 import os
 from fastapi.responses import JSONResponse
 import uuid
+import time
+from collections import OrderedDict
+
+# 会话缓存上限与过期时间（秒）
+SESSION_CACHE_MAXSIZE = int(os.getenv("SESSION_CACHE_MAXSIZE", "1024"))
+SESSION_TTL = float(os.getenv("SESSION_TTL", "1800"))
+
+class SessionCache:
+    """有上限的 LRU 会话缓存，超量或过期的会话会被清退。
+
+    MCP 服务器、LLM 客户端和工具索引都是全局共享的，会话本身只持有
+    消息历史，所以清退就是把条目从缓存里删掉，让历史随之释放。
+    """
+
+    def __init__(self, maxsize: int = SESSION_CACHE_MAXSIZE, ttl: float = SESSION_TTL) -> None:
+        self._entries: "OrderedDict[str, list]" = OrderedDict()
+        self.maxsize = maxsize
+        self.ttl = ttl
+
+    def __contains__(self, session_id: str) -> bool:
+        return session_id in self._entries
+
+    def get(self, session_id: str) -> Optional[ChatSession]:
+        entry = self._entries.get(session_id)
+        if entry is None:
+            return None
+        entry[1] = time.monotonic()
+        self._entries.move_to_end(session_id)
+        return entry[0]
+
+    async def put(self, session_id: str, session: ChatSession) -> None:
+        self._entries[session_id] = [session, time.monotonic()]
+        self._entries.move_to_end(session_id)
+        while len(self._entries) > self.maxsize:
+            evicted_id, _ = self._entries.popitem(last=False)
+            logging.info(f"会话缓存已满，清退最久未使用的会话: {evicted_id}")
+
+    async def evict_expired(self) -> None:
+        """清退超过 TTL 未活动的会话"""
+        now = time.monotonic()
+        expired = [
+            session_id
+            for session_id, (_, last_used) in self._entries.items()
+            if now - last_used > self.ttl
+        ]
+        for session_id in expired:
+            self._entries.pop(session_id)
+            logging.info(f"会话超时，清退: {session_id}")
+
+    def values(self):
+        return [entry[0] for entry in self._entries.values()]
+
+    def clear(self) -> None:
+        self._entries.clear()
 
 # 全局变量来存储服务器实例和会话
 global_servers = {}
-chat_sessions = {}
+chat_sessions = SessionCache()
 initialized = False
+# 启动时构建一次、所有会话共享的状态：系统提示词、LLM 客户端、工具索引
+shared_system_message = None
+shared_llm_client = None
+shared_tool_index = {}
+
+# SSE 输出合并阈值：缓冲区达到该字节数或超过该时限就刷新
+SSE_FLUSH_BYTES = 4096
+SSE_FLUSH_INTERVAL = 0.02  # 秒
+
+# 预编译的 SSE 帧前后缀，省掉每帧一次 f-string 格式化和 encode
+SSE_DATA_PREFIX = b"data: "
+SSE_FRAME_SUFFIX = b"\n\n"
+SSE_DONE_FRAME = b"data: [DONE]\n\n"
+
+# 服务器配置常驻内存，启动时加载一次，写回磁盘时在线程池里原子替换
+SERVERS_CONFIG_PATH = "./servers_config.json"
+servers_config = {"mcpServers": {}}
+_cfg_mtime_ns = 0
+
+def _load_servers_config() -> Dict[str, Any]:
+    """读取服务器配置，按 mtime 判断磁盘文件是否被外部修改。
+
+    文件没变时直接返回内存里的 dict，只花一次 os.stat 的成本。
+    """
+    global servers_config, _cfg_mtime_ns
+    try:
+        st = os.stat(SERVERS_CONFIG_PATH)
+    except FileNotFoundError:
+        return servers_config
+    if st.st_mtime_ns != _cfg_mtime_ns:
+        with open(SERVERS_CONFIG_PATH, "rb") as f:
+            servers_config = orjson.loads(f.read())
+        _cfg_mtime_ns = st.st_mtime_ns
+    return servers_config
+
+def _atomic_write_json(path: str, data: Dict[str, Any]) -> None:
+    """先写临时文件再 os.replace，避免写一半被读到"""
+    global _cfg_mtime_ns
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(orjson.dumps(data, option=orjson.OPT_INDENT_2))
+    os.replace(tmp_path, path)
+    # 自己写入导致的 mtime 变化不需要触发重新加载
+    _cfg_mtime_ns = os.stat(path).st_mtime_ns
 
 @asynccontextmanager
 async def lifespan(app: FastAPI):
     """处理应用的生命周期事件"""
-    global global_servers, initialized
-    
+    global global_servers, initialized, shared_system_message, servers_config
+    global shared_llm_client, shared_tool_index
+
     # 启动时初始化
     try:
+        # 配置加载进内存，后续读写都走这份 dict
+        await asyncio.to_thread(_load_servers_config)
+
         # 初始化系统
         chat_session = await initialize_system()
-        
+
         # 保存所有服务器实例
         for server in chat_session.servers:
             global_servers[server.name] = server
-            
+
+        # 系统提示词、LLM 客户端和工具索引只构建一次，后续会话直接复用
+        shared_system_message = chat_session.system_message
+        shared_llm_client = chat_session.llm_client
+        shared_tool_index = chat_session.tool_index
+
         initialized = True
         logging.info("系统初始化完成")
-        
+
     except Exception as e:
         logging.error(f"系统启动失败: {e}")
         raise
-    
+
+    # 后台定期清退过期会话
+    gc_task = asyncio.create_task(_session_gc_loop())
+
     yield  # 服务运行中
-    
-    # 关闭时清理资源
+
+    gc_task.cancel()
+
+    # 关闭时清理资源（服务器和 LLM 客户端是共享的，各清理一次即可）
     try:
-        # 清理所有会话
-        for session in chat_sessions.values():
-            await session.cleanup_servers()
+        if shared_llm_client is not None:
+            await shared_llm_client.aclose()
+        if global_servers:
+            await asyncio.gather(
+                *(server.cleanup() for server in global_servers.values()),
+                return_exceptions=True,
+            )
     except Exception as e:
         logging.error(f"清理资源时出错: {e}")
     finally:
@@ -81,39 +197,47 @@ class SessionResponse(BaseModel):
     status: str = "success"
     error: Optional[str] = None
 
-async def update_servers_config(new_server: ServerConfig) -> None:
-    """更新servers_config.json文件"""
-    config_path = "./servers_config.json"
-    try:
-        with open(config_path, "r") as f:
-            current_config = json.load(f)
-    except FileNotFoundError:
-        current_config = {"mcpServers": {}}
+async def _session_gc_loop() -> None:
+    """每 60 秒扫描一次过期会话"""
+    while True:
+        await asyncio.sleep(60)
+        try:
+            await chat_sessions.evict_expired()
+        except Exception as e:
+            logging.error(f"清理过期会话时出错: {e}")
 
-    # 添加新服务器配置
-    current_config["mcpServers"][new_server.name] = new_server.config
+async def update_servers_config(new_server: ServerConfig) -> None:
+    """更新内存中的服务器配置并异步写回 servers_config.json"""
+    # 先同步磁盘上可能的外部修改，再添加新服务器配置
+    config = await asyncio.to_thread(_load_servers_config)
+    config.setdefault("mcpServers", {})[new_server.name] = new_server.config
 
-    # 保存更新后的配置
-    with open(config_path, "w") as f:
-        json.dump(current_config, f, indent=2)
+    # 磁盘写放到线程池，避免阻塞事件循环
+    await asyncio.to_thread(_atomic_write_json, SERVERS_CONFIG_PATH, config)
 
 async def get_or_create_chat_session(session_id: str) -> ChatSession:
     """获取或创建聊天会话"""
     from main import ChatSession
     
     logging.info(f"获取或创建会话：{session_id}")
-    if session_id not in chat_sessions:
+    chat_session = chat_sessions.get(session_id)
+    if chat_session is None:
         logging.info(f"创建新会话：{session_id}")
         if not initialized:
             raise RuntimeError("系统未初始化")
-            
-        llm_client = LLMClient(Configuration().llm_api_key)
+
+        # 新会话只持有消息历史，LLM 客户端 / 服务器 / 工具索引全部共享
         servers = list(global_servers.values())
-        chat_session = ChatSession(servers, llm_client)
+        chat_session = ChatSession(
+            servers,
+            shared_llm_client,
+            system_message=shared_system_message,
+            tool_index=shared_tool_index,
+        )
         await chat_session.initialize()
-        chat_sessions[session_id] = chat_session
-        
-    return chat_sessions[session_id]
+        await chat_sessions.put(session_id, chat_session)
+
+    return chat_session
 
 @app.post("/api/create_session")
 async def create_session():
@@ -147,25 +271,63 @@ async def chat_endpoint(request: UserRequest):
         chat_session = await get_or_create_chat_session(request.session_id)
 
         async def generate():
+            # 小块增量先写入缓冲区，按大小或时限合并后再 yield，
+            # 避免每个 LLM 增量都触发一次 ASGI 写和 TCP 包
+            loop = asyncio.get_running_loop()
+            buf = bytearray()
+            deadline = 0.0
+            stream = chat_session.process_message(request.content).__aiter__()
+            pending = None
             try:
-                async for response in chat_session.process_message(request.content):
-                    if response:
-                        try:
-                            # 直接透传响应
-                            if isinstance(response, (dict, list)):
-                                yield f"data: {json.dumps(response, ensure_ascii=False)}\n\n"
-                            else:
-                                yield f"data: {str(response)}\n\n"
-                        except Exception as e:
-                            logging.error(f"处理响应时出错: {str(e)}, 原始响应: {response}")
-                            yield f"data: 处理响应时出错: {str(e)}\n\n"
-                
-                yield "data: [DONE]\n\n"
-                
+                while True:
+                    if pending is None:
+                        pending = asyncio.ensure_future(anext(stream))
+                    timeout = None if not buf else max(deadline - loop.time(), 0)
+                    done, _ = await asyncio.wait({pending}, timeout=timeout)
+                    if not done:
+                        # 刷新时限已到，先把已缓冲的数据发出去
+                        yield bytes(buf)
+                        buf.clear()
+                        continue
+                    try:
+                        response = pending.result()
+                    except StopAsyncIteration:
+                        pending = None
+                        break
+                    pending = None
+                    if not response:
+                        continue
+                    try:
+                        # 直接透传响应（以 bytes 拼帧，Starlette 原样下发）
+                        if isinstance(response, (dict, list)):
+                            payload = orjson.dumps(response)
+                        else:
+                            payload = str(response).encode("utf-8")
+                    except Exception as e:
+                        logging.error(f"处理响应时出错: {str(e)}, 原始响应: {response}")
+                        payload = f"处理响应时出错: {str(e)}".encode("utf-8")
+                    if not buf:
+                        deadline = loop.time() + SSE_FLUSH_INTERVAL
+                    buf += SSE_DATA_PREFIX
+                    buf += payload
+                    buf += SSE_FRAME_SUFFIX
+                    if len(buf) >= SSE_FLUSH_BYTES:
+                        yield bytes(buf)
+                        buf.clear()
+
+                if buf:
+                    yield bytes(buf)
+                yield SSE_DONE_FRAME
+
             except Exception as e:
                 logging.error(f"处理消息时出错: {str(e)}, session_id={request.session_id}")
-                yield f"data: 处理消息时出错: {str(e)}\n\n"
-                yield "data: [DONE]\n\n"
+                if buf:
+                    yield bytes(buf)
+                yield SSE_DATA_PREFIX + f"处理消息时出错: {str(e)}".encode("utf-8") + SSE_FRAME_SUFFIX
+                yield SSE_DONE_FRAME
+            finally:
+                if pending is not None:
+                    pending.cancel()
 
         return StreamingResponse(
             generate(),
@@ -190,6 +352,7 @@ async def chat_endpoint(request: UserRequest):
 
 @app.post("/add_server")
 async def add_server(server: ServerConfig):
+    global shared_system_message
     try:
         # 检查服务器是否已存在
         if server.name in global_servers:
@@ -205,10 +368,24 @@ async def add_server(server: ServerConfig):
         # 创建新的服务器实例
         new_server = create_server(server.name, server.config)
         await new_server.initialize()
-        
+
         # 更新全局服务器字典
         global_servers[server.name] = new_server
 
+        # 把新服务器的工具并入共享索引，后续会话才能路由到它
+        try:
+            for tool in await new_server.list_tools():
+                shared_tool_index[tool.name] = new_server
+
+            # 重建共享系统提示词：提示词里只会列出构建时已知的工具，
+            # 不重建的话新会话永远不会被告知（也就不会调用）新工具
+            all_tools = []
+            for srv in global_servers.values():
+                all_tools.extend(await srv.list_tools())
+            shared_system_message = build_system_message(all_tools)
+        except Exception as e:
+            logging.error(f"列出新服务器工具失败: {e}")
+
         return {
             "status": "success", 
             "message": f"服务器 {server.name} 添加成功",
@@ -1,12 +1,16 @@
 import asyncio
+import io
 import json
 import logging
 import os
+import random
 import shutil
 from contextlib import AsyncExitStack
+from dataclasses import dataclass
 from typing import Any, AsyncGenerator, Optional, Union
 
 import httpx
+import orjson
 from dotenv import load_dotenv
 from mcp import ClientSession, StdioServerParameters
 from mcp.client.stdio import stdio_client
@@ -20,17 +24,70 @@ class ServerType:
     STDIO = "stdio"
     SSE = "sse"
 
+# 单条用户消息最多允许的 LLM 工具调用轮数，防止模型不输出
+# [TASK_COMPLETE] 时陷入死循环
+MAX_TOOL_HOPS = int(os.getenv("MAX_TOOL_HOPS", "8"))
+
+# 历史消息条数上限（不含系统消息）。超限后只保留系统消息 + 最近
+# 这么多条，防止每轮重传/重算的上下文随会话长度无限增长
+LLM_MAX_HISTORY = int(os.getenv("LLM_MAX_HISTORY", "40"))
+
+# 重试退避的单次等待上限（秒）
+MAX_BACKOFF = 30.0
+
+def _backoff(delay: float, attempt: int) -> float:
+    """指数退避加随机抖动，错开并发调用方的重试时刻"""
+    return min(delay * (2 ** (attempt - 1)) * random.uniform(0.5, 1.5), MAX_BACKOFF)
+
+# 回复结束/后续任务哨兵。完成标记按提示词约定出现在回复末尾，
+# 检测时只扫描最后一小段而不是整条消息
+TASK_COMPLETE = "[TASK_COMPLETE]"
+TASK_COMPLETE_LEN = len(TASK_COMPLETE)
+FOLLOW_UP = "接下来"
+SENTINEL_WINDOW = 64
+
+# 置 LLM_PROMPT_CACHE=1 时在系统消息上带 cache_control 标记，
+# 提示支持该字段的服务端（Anthropic 等）缓存这段稳定前缀
+LLM_PROMPT_CACHE = os.getenv("LLM_PROMPT_CACHE") == "1"
+
+def _system_msg(content: str) -> dict[str, Any]:
+    """构造系统消息，按需附加服务端提示词缓存标记"""
+    message: dict[str, Any] = {"role": "system", "content": content}
+    if LLM_PROMPT_CACHE:
+        message["cache_control"] = {"type": "ephemeral"}
+    return message
+
+def _strip_task_complete(text: str) -> str:
+    """去掉末尾的 [TASK_COMPLETE] 标记（从尾部查找，避免全文扫描）"""
+    idx = text.rfind(TASK_COMPLETE)
+    if idx == -1:
+        return text.strip()
+    return (text[:idx] + text[idx + TASK_COMPLETE_LEN:]).strip()
+
+@dataclass(frozen=True, slots=True)
 class Configuration:
-    """Manages configuration and environment variables for the MCP client."""
+    """Immutable configuration snapshot for the MCP client.
 
-    def __init__(self) -> None:
-        """Initialize configuration with environment variables."""
-        self.load_env()
-        self.api_key = os.getenv("LLM_API_KEY")
-        self.llm_base_url = os.getenv("LLM_BASE_URL")
-        self.llm_model = os.getenv("LLM_MODEL")
-        self.temperature = os.getenv("LLM_TEMPERATURE")
+    环境变量只在 from_env() 里读一次并完成类型转换，之后各处持有
+    同一个不可变实例，不再反复查 os.environ。
+    """
 
+    api_key: Optional[str] = None
+    llm_base_url: Optional[str] = None
+    llm_model: Optional[str] = None
+    temperature: float = 0.0
+
+    @classmethod
+    def from_env(cls) -> "Configuration":
+        """Build a configuration from environment variables (.env included)."""
+        cls.load_env()
+        raw_temperature = os.getenv("LLM_TEMPERATURE")
+        return cls(
+            api_key=os.getenv("LLM_API_KEY"),
+            llm_base_url=os.getenv("LLM_BASE_URL"),
+            llm_model=os.getenv("LLM_MODEL"),
+            temperature=float(raw_temperature) if raw_temperature else 0.0,
+        )
 
     @staticmethod
     def load_env() -> None:
@@ -71,19 +128,26 @@ class Configuration:
 class Tool:
     """Represents a tool with its properties and formatting."""
 
+    __slots__ = ("name", "description", "input_schema", "_formatted")
+
     def __init__(
         self, name: str, description: str, input_schema: dict[str, Any]
     ) -> None:
         self.name: str = name
         self.description: str = description
         self.input_schema: dict[str, Any] = input_schema
+        # 构造时就把 LLM 可读的描述渲染好，后续调用零字符串拼接
+        self._formatted: str = self._render()
 
     def format_for_llm(self) -> str:
         """Format tool information for LLM.
 
         Returns:
-            A formatted string describing the tool.
+            A formatted string describing the tool (precomputed at init).
         """
+        return self._formatted
+
+    def _render(self) -> str:
         args_desc = []
         if "properties" in self.input_schema:
             for param_name, param_info in self.input_schema["properties"].items():
@@ -104,11 +168,22 @@ Arguments:
 class Server:
     """Manages MCP server connections and tool execution."""
 
+    __slots__ = (
+        "name",
+        "config",
+        "stdio_context",
+        "session",
+        "_tools_cache",
+        "_cleanup_lock",
+        "exit_stack",
+    )
+
     def __init__(self, name: str, config: dict[str, Any]) -> None:
         self.name: str = name
         self.config: dict[str, Any] = config
         self.stdio_context: Any | None = None
         self.session: ClientSession | None = None
+        self._tools_cache: list[Tool] | None = None
         self._cleanup_lock: asyncio.Lock = asyncio.Lock()
         self.exit_stack: AsyncExitStack = AsyncExitStack()
 
@@ -147,6 +222,9 @@ class Server:
     async def list_tools(self) -> list[Any]:
         """List available tools from the server.
 
+        The result is cached after the first call so repeated listings
+        don't pay an MCP round-trip per request.
+
         Returns:
             A list of available tools.
 
@@ -156,6 +234,9 @@ class Server:
         if not self.session:
             raise RuntimeError(f"Server {self.name} not initialized")
 
+        if self._tools_cache is not None:
+            return self._tools_cache
+
         tools_response = await self.session.list_tools()
         tools = []
 
@@ -164,6 +245,7 @@ class Server:
                 for tool in item[1]:
                     tools.append(Tool(tool.name, tool.description, tool.inputSchema))
 
+        self._tools_cache = tools
         return tools
 
     async def execute_tool(
@@ -204,8 +286,9 @@ class Server:
                     f"Error executing tool: {e}. Attempt {attempt} of {retries}."
                 )
                 if attempt < retries:
-                    logging.info(f"Retrying in {delay} seconds...")
-                    await asyncio.sleep(delay)
+                    wait_time = _backoff(delay, attempt)
+                    logging.info(f"Retrying in {wait_time:.1f} seconds...")
+                    await asyncio.sleep(wait_time)
                 else:
                     logging.error("Max retries reached. Failing.")
                     raise
@@ -217,12 +300,45 @@ class Server:
                 await self.exit_stack.aclose()
                 self.session = None
                 self.stdio_context = None
+                self._tools_cache = None
             except Exception as e:
                 logging.error(f"Error during cleanup of server {self.name}: {e}")
     
+def _sse_httpx_factory(
+    headers: Optional[dict[str, str]] = None,
+    timeout: Optional[httpx.Timeout] = None,
+    auth: Optional[httpx.Auth] = None,
+) -> httpx.AsyncClient:
+    """供 mcp sse_client 使用的 httpx 客户端工厂。
+
+    统一连接池参数并开启 TCP keepalive 复用，重连/重试走既有连接池
+    而不是每次重新做 TCP+TLS 握手。
+    """
+    return httpx.AsyncClient(
+        headers=headers,
+        timeout=timeout if timeout is not None else httpx.Timeout(30.0, read=300.0),
+        auth=auth,
+        limits=httpx.Limits(
+            max_keepalive_connections=8,
+            max_connections=16,
+            keepalive_expiry=60.0,
+        ),
+        follow_redirects=True,
+    )
+
 class SSEServer:
     """Manages SSE-based MCP server connections and tool execution."""
 
+    __slots__ = (
+        "name",
+        "config",
+        "base_url",
+        "session",
+        "tools",
+        "_cleanup_lock",
+        "exit_stack",
+    )
+
     def __init__(self, name: str, config: dict[str, Any]) -> None:
         self.name: str = name
         self.config: dict[str, Any] = config
@@ -231,17 +347,17 @@ class SSEServer:
         self.tools: list[Tool] = []
         self._cleanup_lock: asyncio.Lock = asyncio.Lock()
         self.exit_stack: AsyncExitStack = AsyncExitStack()
-        self._streams_context = None
-        self._session_context = None
 
     async def initialize(self) -> None:
         """Connect to an MCP server running with SSE transport"""
-        # Store the context managers so they stay alive
-        self._streams_context = sse_client(url=self.base_url)
-        streams = await self._streams_context.__aenter__()
-
-        self._session_context = ClientSession(*streams)
-        self.session: ClientSession = await self._session_context.__aenter__()
+        # 上下文管理器进 exit_stack 托管（与 Server 一致），
+        # 由它负责按逆序安全退出
+        streams = await self.exit_stack.enter_async_context(
+            sse_client(url=self.base_url, httpx_client_factory=_sse_httpx_factory)
+        )
+        self.session = await self.exit_stack.enter_async_context(
+            ClientSession(*streams)
+        )
 
         # Initialize
         await self.session.initialize()
@@ -260,6 +376,20 @@ class SSEServer:
             raise RuntimeError(f"SSE Server {self.name} not initialized")
         return self.tools
 
+    async def ping(self) -> bool:
+        """探测连接是否仍然可用。
+
+        用 MCP 协议层的 ping，而不是调用名为 "ping" 的工具——
+        多数服务器并没有实现那个工具，会触发整套重连逻辑。
+        """
+        if not self.session:
+            return False
+        try:
+            await self.session.send_ping()
+            return True
+        except Exception:
+            return False
+
     async def execute_tool(
         self,
         tool_name: str,
@@ -295,18 +425,22 @@ class SSEServer:
                 logging.error(f"Error executing tool (attempt {attempt}/{retries}): {str(e)}")
                 
                 if attempt < retries:
-                    wait_time = delay * (2 ** (attempt - 1))  # 指数退避
-                    logging.info(f"Waiting {wait_time} seconds before retry...")
+                    wait_time = _backoff(delay, attempt)  # 带抖动的指数退避
+                    logging.info(f"Waiting {wait_time:.1f} seconds before retry...")
                     await asyncio.sleep(wait_time)
                     
-                    # 如果是连接相关错误，尝试重新初始化
+                    # 如果是连接相关错误，先 ping 确认连接确实断了再重建，
+                    # 避免工具自身的报错引发不必要的整条连接重握手
                     if isinstance(e, (ConnectionError, RuntimeError)) or "connection" in str(e).lower():
-                        try:
-                            logging.info("Attempting to reinitialize connection...")
-                            await self.cleanup()
-                            await self.initialize()
-                        except Exception as re_init_error:
-                            logging.error(f"Failed to reinitialize: {re_init_error}")
+                        if await self.ping():
+                            logging.info("Connection still alive, skipping reinitialize")
+                        else:
+                            try:
+                                logging.info("Attempting to reinitialize connection...")
+                                await self.cleanup()
+                                await self.initialize()
+                            except Exception as re_init_error:
+                                logging.error(f"Failed to reinitialize: {re_init_error}")
                 
         # 如果所有重试都失败了
         raise RuntimeError(f"Tool execution failed after {retries} attempts. Last error: {last_error}")
@@ -315,13 +449,8 @@ class SSEServer:
         """Properly clean up the session and streams"""
         async with self._cleanup_lock:
             try:
-                if self._session_context:
-                    await self._session_context.__aexit__(None, None, None)
-                if self._streams_context:
-                    await self._streams_context.__aexit__(None, None, None)
+                await self.exit_stack.aclose()
                 self.session = None
-                self._streams_context = None
-                self._session_context = None
             except Exception as e:
                 logging.error(f"Error during cleanup of SSE server {self.name}: {e}")
                 # 不要在这里抛出异常，以确保清理过程总是完成
@@ -329,13 +458,41 @@ class SSEServer:
 class LLMClient:
     """Manages communication with the LLM provider."""
 
-    def __init__(self, api_key: str) -> None:
-        self.api_key: str = api_key
-        self.llm_base_url = os.getenv("LLM_BASE_URL")
-        self.llm_model = os.getenv("LLM_MODEL")
-        self.temperature = os.getenv("LLM_TEMPERATURE")
+    __slots__ = ("api_key", "llm_base_url", "llm_model", "temperature", "_client")
+
+    def __init__(self, config: Configuration) -> None:
+        self.api_key: str = config.llm_api_key
+        self.llm_base_url = config.llm_base_url
+        self.llm_model = config.llm_model
+        self.temperature = config.temperature
+        self._client: Optional[httpx.AsyncClient] = None
+
+    def _get_client(self) -> httpx.AsyncClient:
+        """Return the shared HTTP client, creating it lazily on first use.
 
-    def get_response(self, messages: list[dict[str, str]]) -> str:
+        A single client keeps the connection pool alive across LLM calls,
+        avoiding a TCP + TLS handshake per request.
+        """
+        if self._client is None or self._client.is_closed:
+            # http2=True 经 ALPN 协商：端点支持 h2 时多路复用并发请求
+            # 并压缩重复头部，不支持时自动回落 HTTP/1.1
+            self._client = httpx.AsyncClient(
+                http2=True,
+                timeout=httpx.Timeout(60.0, connect=30.0),
+                limits=httpx.Limits(
+                    max_keepalive_connections=32,
+                    max_connections=128,
+                    keepalive_expiry=30.0,
+                ),
+            )
+        return self._client
+
+    async def aclose(self) -> None:
+        """Close the shared HTTP client and its connection pool."""
+        if self._client is not None and not self._client.is_closed:
+            await self._client.aclose()
+
+    async def get_response(self, messages: list[dict[str, str]]) -> str:
         """Get a response from the LLM.
 
         Args:
@@ -356,18 +513,18 @@ class LLMClient:
         payload = {
             "messages": messages,
             "model": self.llm_model,
-            "temperature": 0,
+            "temperature": self.temperature,
             "max_tokens": 4096,
             "stream": False
         }
 
         try:
-            timeout = httpx.Timeout(30.0, connect=30.0)
-            with httpx.Client(timeout=timeout) as client:
-                response = client.post(url, headers=headers, json=payload)
-                response.raise_for_status()
-                data = response.json()
-                return data["choices"][0]["message"]["content"]
+            response = await self._get_client().post(
+                url, headers=headers, content=orjson.dumps(payload)
+            )
+            response.raise_for_status()
+            data = response.json()
+            return data["choices"][0]["message"]["content"]
 
         except httpx.RequestError as e:
             error_message = f"Error getting LLM response: {str(e)}"
@@ -403,90 +560,173 @@ class LLMClient:
         payload = {
             "messages": messages,
             "model": self.llm_model,
-            "temperature": 0,
+            "temperature": self.temperature,
             "max_tokens": 4096,
             "stream": True  # 启用流式
         }
 
-        timeout = httpx.Timeout(60.0, connect=60.0)
-        async with httpx.AsyncClient(timeout=timeout) as client:
-            try:
-                async with client.stream("POST", url, headers=headers, json=payload) as response:
-                    response.raise_for_status()
-                    async for chunk in response.aiter_lines():
-                        if chunk.strip().startswith("data: "):
-                            json_str = chunk.strip()[6:]
-                            if json_str == "[DONE]":
-                                break
-                            try:
-                                data = json.loads(json_str)
-                                if "content" in data["choices"][0]["delta"]:
-                                    yield data["choices"][0]["delta"]["content"]
-                            except json.JSONDecodeError:
-                                continue
-            except Exception as e:
-                logging.error(f"Stream error: {str(e)}")
-                yield f"[流式响应错误: {str(e)}]"
+        client = self._get_client()
+        try:
+            async with client.stream(
+                "POST", url, headers=headers, content=orjson.dumps(payload)
+            ) as response:
+                response.raise_for_status()
+                # 按字节增量解析 SSE 行：只有真正携带 JSON 的 data 行才切片，
+                # 空行（事件边界）、event:/注释行原地跳过，零分配
+                buf = bytearray()
+                done = False
+                async for chunk in response.aiter_bytes():
+                    buf += chunk
+                    start = 0
+                    while not done:
+                        nl = buf.find(b"\n", start)
+                        if nl == -1:
+                            break
+                        line_start = start
+                        line_end = nl
+                        start = nl + 1
+                        if line_end > line_start and buf[line_end - 1] == 0x0D:  # \r
+                            line_end -= 1
+                        if line_end == line_start:
+                            continue
+                        if (
+                            line_end - line_start == 12
+                            and buf.startswith(b"data: [DONE]", line_start, line_end)
+                        ):
+                            done = True
+                            break
+                        if not buf.startswith(b"data: ", line_start, line_end):
+                            continue
+                        json_bytes = buf[line_start + 6:line_end]
+                        try:
+                            data = orjson.loads(json_bytes)
+                            if "content" in data["choices"][0]["delta"]:
+                                yield data["choices"][0]["delta"]["content"]
+                        except orjson.JSONDecodeError:
+                            continue
+                    del buf[:start]
+                    if done:
+                        break
+        except Exception as e:
+            logging.error(f"Stream error: {str(e)}")
+            yield f"[流式响应错误: {str(e)}]"
+
+def build_system_message(tools: list[Tool]) -> str:
+    """根据工具列表构建系统提示词。
+
+    只在服务器启动时调用一次，之后所有会话复用同一个字符串，
+    避免每次新建会话都重新拼接多 KB 的提示词。
+    """
+    tools_description = "\n".join(tool.format_for_llm() for tool in tools)
+    return (
+        "You are a helpful assistant with access to these tools:\n\n"
+        f"{tools_description}\n"
+        "Choose the appropriate tool based on the user's question. "
+        "If no tool is needed, reply directly.\n\n"
+        "IMPORTANT: When you need to use a tool, you must ONLY respond with "
+        "the exact JSON object format below, nothing else, 不能有前缀和后缀:\n"
+        "{\n"
+        '    "tool": "tool-name",\n'
+        '    "arguments": {\n'
+        '        "argument-name": "value"\n'
+        "    }\n"
+        "}\n\n"
+        "After receiving a tool's response:\n"
+        "1. Transform the raw data into a natural, conversational response\n"
+        "2. Keep responses concise but informative\n"
+        "3. Focus on the most relevant information\n"
+        "4. Use appropriate context from the user's question\n"
+        "5. Avoid simply repeating the raw data\n"
+        "6. When all tasks are completed, end your response with '[TASK_COMPLETE]'\n"
+        "7. If there are follow-up tasks, use '接下来' to indicate them\n\n"
+        "Please use only the tools that are explicitly defined above."
+    )
 
 class ChatSession:
     """Orchestrates the interaction between user, LLM, and tools."""
 
-    def __init__(self, servers: list[Union[Server, SSEServer]], llm_client: LLMClient) -> None:
+    __slots__ = (
+        "servers",
+        "llm_client",
+        "messages",
+        "system_message",
+        "tools_description",
+        "tool_index",
+        "max_history_messages",
+    )
+
+    def __init__(
+        self,
+        servers: list[Union[Server, SSEServer]],
+        llm_client: LLMClient,
+        system_message: Optional[str] = None,
+        tool_index: Optional[dict[str, Union[Server, SSEServer]]] = None,
+    ) -> None:
         self.servers: list[Union[Server, SSEServer]] = servers
         self.llm_client: LLMClient = llm_client
-        self.messages = []
-        self.system_message = None
+        # 历史消息常驻在会话对象上（按 session_id 保存），前缀字节稳定，
+        # 便于 LLM 服务端做 prefix KV-cache 复用
+        self.messages: list[dict[str, Any]] = []
+        if system_message is not None:
+            self.messages.append(_system_msg(system_message))
+        self.system_message = system_message
         self.tools_description = None
+        self.tool_index: dict[str, Union[Server, SSEServer]] = tool_index or {}
+        self.max_history_messages: int = LLM_MAX_HISTORY
 
     async def initialize(self) -> None:
         """初始化聊天会话，连接服务器并获取工具列表"""
         try:
-            # 初始化所有服务器
-            for server in self.servers:
-                try:
-                    await server.initialize()
-                except Exception as e:
-                    logging.error(f"Failed to initialize server: {e}")
-                    await self.cleanup_servers()
-                    raise
-
-            # 获取所有工具列表
+            # 共享了工具索引和系统提示词的会话（API 场景）只持有
+            # 消息历史和引用，服务器连接无需重复初始化
+            if self.tool_index and self.system_message is not None:
+                if not self.messages:
+                    self.messages = [_system_msg(self.system_message)]
+                logging.info("Chat session initialized from shared state")
+                return
+
+            # 并发初始化所有服务器，冷启动耗时取决于最慢的一个而不是总和
+            init_results = await asyncio.gather(
+                *(server.initialize() for server in self.servers),
+                return_exceptions=True,
+            )
+            failures = [
+                (server, result)
+                for server, result in zip(self.servers, init_results)
+                if isinstance(result, BaseException)
+            ]
+            if failures:
+                for server, error in failures:
+                    logging.error(f"Failed to initialize server {server.name}: {error}")
+                await self.cleanup_servers()
+                raise failures[0][1]
+
+            # 并发获取所有工具列表，并建立 工具名 -> 服务器 的索引
+            results = await asyncio.gather(
+                *(server.list_tools() for server in self.servers),
+                return_exceptions=True,
+            )
             all_tools = []
-            for server in self.servers:
-                tools = await server.list_tools()
-                all_tools.extend(tools)
+            self.tool_index = {}
+            for server, result in zip(self.servers, results):
+                if isinstance(result, BaseException):
+                    logging.error(f"Failed to list tools for server {server.name}: {result}")
+                    continue
+                all_tools.extend(result)
+                for tool in result:
+                    self.tool_index[tool.name] = server
 
             # 构建工具描述
             self.tools_description = all_tools
 
-            # 构建系统消息
-            self.system_message = (
-                "You are a helpful assistant with access to these tools:\n\n"
-                f"{self.tools_description}\n"
-                "Choose the appropriate tool based on the user's question. "
-                "If no tool is needed, reply directly.\n\n"
-                "IMPORTANT: When you need to use a tool, you must ONLY respond with "
-                "the exact JSON object format below, nothing else, 不能有前缀和后缀:\n"
-                "{\n"
-                '    "tool": "tool-name",\n'
-                '    "arguments": {\n'
-                '        "argument-name": "value"\n'
-                "    }\n"
-                "}\n\n"
-                "After receiving a tool's response:\n"
-                "1. Transform the raw data into a natural, conversational response\n"
-                "2. Keep responses concise but informative\n"
-                "3. Focus on the most relevant information\n"
-                "4. Use appropriate context from the user's question\n"
-                "5. Avoid simply repeating the raw data\n"
-                "6. When all tasks are completed, end your response with '[TASK_COMPLETE]'\n"
-                "7. If there are follow-up tasks, use '接下来' to indicate them\n\n"
-                "Please use only the tools that are explicitly defined above."
-            )
+            # 构建系统消息（已在外部构建好的直接复用）
+            if self.system_message is None:
+                self.system_message = build_system_message(all_tools)
+
+            # 初始化消息列表（已有历史时不重建，保持前缀稳定）
+            if not self.messages:
+                self.messages = [_system_msg(self.system_message)]
 
-            # 初始化消息列表
-            self.messages = [{"role": "system", "content": self.system_message}]
-            
             logging.info("Chat session initialized successfully")
             
         except Exception as e:
@@ -494,93 +734,140 @@ class ChatSession:
             raise
 
 
+    def _parse_tool_call(self, llm_response: str) -> Optional[dict[str, Any]]:
+        """解析回复中的工具调用，不是合法调用时返回 None。
+
+        纯文本回复（绝大多数情况）在前缀检查就被挡掉，不进 JSON
+        解析和异常流程。
+        """
+        stripped = llm_response.lstrip()
+        if not stripped.startswith("{"):
+            return None
+        try:
+            tool_call = orjson.loads(stripped)
+        except orjson.JSONDecodeError:
+            return None
+        if isinstance(tool_call, dict) and "tool" in tool_call and "arguments" in tool_call:
+            return tool_call
+        return None
+
     async def process_llm_response(self, llm_response: str) -> AsyncGenerator[str, None]:
         """Process the LLM response and execute tools if needed."""
-        try:
-            tool_call = json.loads(llm_response)
-            if "tool" in tool_call and "arguments" in tool_call:
-                print(f"Executing tool: {tool_call['tool']} With arguments: {tool_call['arguments']}")
-                yield f"Executing tool: {tool_call['tool']} With arguments: {tool_call['arguments']}"
-                
-                found = False
-                for server in self.servers:
-                    tools = await server.list_tools()
-                    if any(tool.name == tool_call["tool"] for tool in tools):
-                        try:
-                            result = await server.execute_tool(
-                                tool_call["tool"], 
-                                tool_call["arguments"]
-                            )
-                            if isinstance(result, dict) and "progress" in result:
-                                progress = result["progress"]
-                                total = result["total"]
-                                percentage = (progress / total) * 100
-                                print(f"Progress: {progress}/{total} ({percentage:.1f}%)")
-                                yield f"Progress: {progress}/{total} ({percentage:.1f}%)"
-                            print(f"Tool execution result: {result}")
-                            yield f"Tool execution result: {result}"
-                            found = True
-                        except Exception as e:
-                            error_msg = f"Error executing tool: {str(e)}"
-                            logging.error(error_msg)
-                            yield error_msg
-                if not found:
-                    yield f"No server found with tool: {tool_call['tool']}"
-            else:
-                yield llm_response
-        except json.JSONDecodeError:
+        tool_call = self._parse_tool_call(llm_response)
+        if tool_call is None:
             yield llm_response
+            return
+        async for chunk in self._execute_tool_call(tool_call):
+            yield chunk
+
+    async def _execute_tool_call(self, tool_call: dict[str, Any]) -> AsyncGenerator[str, None]:
+        """执行一次已解析的工具调用并产出过程信息"""
+        print(f"Executing tool: {tool_call['tool']} With arguments: {tool_call['arguments']}")
+        yield f"Executing tool: {tool_call['tool']} With arguments: {tool_call['arguments']}"
+
+        server = self.tool_index.get(tool_call["tool"])
+        if server is None:
+            yield f"No server found with tool: {tool_call['tool']}"
+        else:
+            try:
+                result = await server.execute_tool(
+                    tool_call["tool"],
+                    tool_call["arguments"]
+                )
+                if isinstance(result, dict) and "progress" in result:
+                    progress = result["progress"]
+                    total = result["total"]
+                    percentage = (progress / total) * 100
+                    print(f"Progress: {progress}/{total} ({percentage:.1f}%)")
+                    yield f"Progress: {progress}/{total} ({percentage:.1f}%)"
+                print(f"Tool execution result: {result}")
+                yield f"Tool execution result: {result}"
+            except Exception as e:
+                error_msg = f"Error executing tool: {str(e)}"
+                logging.error(error_msg)
+                yield error_msg
+
 
+    def _trim_history(self) -> None:
+        """历史超限时收缩为 系统消息 + 最近 max_history_messages 条。
+
+        收缩会使下一次请求的前缀发生变化（牺牲一次 KV-cache 命中），
+        但把每轮的重传和 prefill 成本限制在常数规模。
+        """
+        if len(self.messages) > self.max_history_messages + 1:
+            self.messages = (
+                self.messages[:1] + self.messages[-self.max_history_messages:]
+            )
 
     async def process_message(self, user_input: str) -> AsyncGenerator[str, None]:
         """处理用户输入并生成响应"""
         try:
             self.messages.append({"role": "user", "content": user_input})
-            final_response = []
-            full_response = []
-            assistant_message = ""
-            while True:
-                full_response = []
-                
+            self._trim_history()
+            for _ in range(MAX_TOOL_HOPS):
+                # 边收边判断：第一个非空白字符不是 "{" 就确定是纯文本，
+                # 立刻切换为透传模式，首 token 延迟只取决于首个增量；
+                # 只有疑似工具调用的回复才整段缓冲后再解析
+                response_buf = io.StringIO()
+                passthrough = False
+                head = ""
                 async for chunk in self.llm_client.get_stream_response(self.messages):
-                    full_response.append(chunk)
-                llm_response = "".join(full_response)   
-
-                processed_chunks = []
-                async for chunk in self.process_llm_response(llm_response):
-                    processed_chunks.append(chunk)
-                    yield chunk
-                result = "".join(processed_chunks)
+                    response_buf.write(chunk)
+                    if passthrough:
+                        yield chunk
+                        continue
+                    head += chunk
+                    stripped_head = head.lstrip()
+                    if not stripped_head:
+                        continue  # 仍是前导空白，继续等
+                    if stripped_head.startswith("{"):
+                        continue  # 疑似工具调用，缓冲到流结束
+                    passthrough = True
+                    yield head
+                llm_response = response_buf.getvalue()
+
+                # 明确跟踪"本轮是否尝试了工具调用"，而不是比较前后文本
+                # 是否相同（对空白变化过于敏感）
+                tool_executed = False
+                if not passthrough:
+                    tool_call = self._parse_tool_call(llm_response)
+                    if tool_call is None:
+                        # 空响应或整段缓冲下来的非工具文本
+                        yield llm_response
+                    else:
+                        async for chunk in self._execute_tool_call(tool_call):
+                            yield chunk
+                        tool_executed = True
 
-                if result != llm_response:
-                    assistant_message+="\n\n"+llm_response
+                if tool_executed:
                     self.messages.append({"role": "assistant", "content": llm_response})
-                    
+
+                    final_buf = io.StringIO()
                     async for chunk in self.llm_client.get_stream_response(self.messages):
-                        final_response.append(chunk)
+                        final_buf.write(chunk)
                         print(f"chunk: {chunk}")
                         yield chunk
 
-                    final_response_text = "".join(final_response)
+                    final_response_text = final_buf.getvalue()
                     # print(f"final_response: {final_response_text}")
                     
-                    # 检查是否任务完成
-                    if "[TASK_COMPLETE]" in final_response_text:
-                        clean_response = final_response_text.replace("[TASK_COMPLETE]", "").strip()
+                    # 检查是否任务完成（哨兵只会在末尾，扫描尾部窗口即可）
+                    if TASK_COMPLETE in final_response_text[-SENTINEL_WINDOW:]:
+                        clean_response = _strip_task_complete(final_response_text)
                         self.messages.append({"role": "assistant", "content": clean_response})
                         break
-                    
-                    # 处理后续任务 
+
+                    # 处理后续任务
                     else:
                         self.messages.append({"role": "assistant", "content": final_response_text})
-                    
+
                 else:
-                    if "[TASK_COMPLETE]" in llm_response:
-                        clean_response = llm_response.replace("[TASK_COMPLETE]", "").strip()
+                    if TASK_COMPLETE in llm_response[-SENTINEL_WINDOW:]:
+                        clean_response = _strip_task_complete(llm_response)
                         self.messages.append({"role": "assistant", "content": clean_response})
                         break
                     self.messages.append({"role": "assistant", "content": llm_response})
-                    if "接下来" not in llm_response:
+                    if FOLLOW_UP not in llm_response:
                         break
             
                
@@ -600,17 +887,24 @@ class ChatSession:
             except Exception as e:
                 logging.warning(f"Warning during final cleanup: {e}")
 
+        try:
+            await self.llm_client.aclose()
+        except Exception as e:
+            logging.warning(f"Warning closing LLM client: {e}")
+
+# 配置关键字 -> 服务器实现 的分发表：含 url 视为 SSE，含 command 视为 STDIO。
+# 新的服务器类型只需在这里加一项
+_SERVER_TYPES: tuple = (
+    ("url", SSEServer),
+    ("command", Server),
+)
+
 def create_server(name: str, config: dict[str, Any]) -> Union[Server, SSEServer]:
     """Factory function to create appropriate server instance based on configuration content."""
-    # 通过配置内容判断服务器类型
-    # 如果配置中包含 url，则认为是 SSE 服务器
-    # 如果配置中包含 command，则认为是 STDIO 服务器
-    if "url" in config:
-        return SSEServer(name, config)
-    elif "command" in config:
-        return Server(name, config)
-    else:
-        raise ValueError(f"Invalid server configuration for {name}: must contain either 'url' for SSE or 'command' for STDIO")
+    for key, server_cls in _SERVER_TYPES:
+        if key in config:
+            return server_cls(name, config)
+    raise ValueError(f"Invalid server configuration for {name}: must contain either 'url' for SSE or 'command' for STDIO")
 
 async def initialize_system() -> ChatSession:
     """初始化系统，建立MCP Server连接并返回会话实例
@@ -621,7 +915,7 @@ async def initialize_system() -> ChatSession:
     try:
         print("正在初始化系统...")
         # 加载配置
-        config = Configuration()
+        config = Configuration.from_env()
         server_config = config.load_config("servers_config.json")
         
         # 创建并初始化服务器
@@ -631,7 +925,7 @@ async def initialize_system() -> ChatSession:
         ]
         
         # 创建LLM客户端
-        llm_client = LLMClient(config.llm_api_key)
+        llm_client = LLMClient(config)
         
         # 创建并初始化聊天会话
         chat_session = ChatSession(servers, llm_client)
@@ -644,37 +938,47 @@ async def initialize_system() -> ChatSession:
         logging.error(f"系统初始化失败: {str(e)}")
         raise
 
+async def run_cli(chat_session: ChatSession) -> None:
+    """命令行 REPL，仅供本地测试使用。
+
+    阻塞的 input() 只存在于这里，API 请求路径只经过
+    ChatSession.process_message，不会触碰到命令行交互。
+    """
+    print("\n开始聊天会话 (输入 'quit' 或 'exit' 退出):")
+    while True:
+        try:
+            # input() 放到线程池执行，等待输入时事件循环仍然可以
+            # 处理 SSE 心跳 / 重连等后台协程
+            user_input = (await asyncio.to_thread(input, "\n你: ")).strip()
+            if user_input.lower() in ["quit", "exit"]:
+                print("\n退出中...")
+                break
+
+            print("\n助手: ", end="", flush=True)
+            async for response in chat_session.process_message(user_input):
+                print(response, end="\n\n", flush=True)
+            print()  # 换行
+
+        except KeyboardInterrupt:
+            print("\n\n收到中断信号，正在退出...")
+            break
+        except Exception as e:
+            print(f"\n错误: {str(e)}")
+            continue
+
 async def main() -> None:
     """命令行测试入口"""
     try:
         # 初始化系统
         chat_session= await initialize_system()
-        
+
         # 处理用户输入
-        print("\n开始聊天会话 (输入 'quit' 或 'exit' 退出):")
-        while True:
-            try:
-                user_input = input("\n你: ").strip()
-                if user_input.lower() in ["quit", "exit"]:
-                    print("\n退出中...")
-                    break
-
-                print("\n助手: ", end="", flush=True)
-                async for response in chat_session.process_message(user_input):
-                    print(response, end="\n\n", flush=True)
-                print()  # 换行
-
-            except KeyboardInterrupt:
-                print("\n\n收到中断信号，正在退出...")
-                break
-            except Exception as e:
-                print(f"\n错误: {str(e)}")
-                continue
-                
+        await run_cli(chat_session)
+
     except Exception as e:
         print(f"系统错误: {str(e)}")
     finally:
-        # 清理资源
+        # 清理资源（cleanup_servers 会一并关闭 LLM 客户端）
         if 'chat_session' in locals():
             await chat_session.cleanup_servers()
         print("\n系统已关闭。")
@@ -1,19 +1,30 @@
 import os
-import json
 import asyncio
+import hashlib
 import logging
 import time  # 添加time模块
+from contextlib import AsyncExitStack, asynccontextmanager
 from datetime import datetime
 from typing import Dict, List, Any, Optional
-from functools import wraps
 
-from flask import Flask, request, jsonify, Response, stream_with_context
-from flask_cors import CORS
+import orjson
+from fastapi import FastAPI, Request
+from fastapi.responses import ORJSONResponse, Response, StreamingResponse
+from fastapi.middleware.cors import CORSMiddleware
+from pydantic import BaseModel, Field
+import uvicorn
 
 # MCP相关导入
 from mcp import ClientSession, StdioServerParameters, types
 from mcp.client.stdio import stdio_client
 
+# 配置日志
+logging.basicConfig(
+    level=logging.INFO,
+    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+)
+logger = logging.getLogger(__name__)
+
 # 尝试导入SSE相关模块
 try:
     from mcp.client.sse import sse_client
@@ -22,99 +33,268 @@ except ImportError:
     logger.warning("SSE传输模块不可用，仅支持stdio传输")
     SSE_AVAILABLE = False
 
-# 配置日志
-logging.basicConfig(
-    level=logging.INFO,
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s'
-)
-logger = logging.getLogger(__name__)
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # 在主事件循环上启动会话清理任务
+    cleanup_task = asyncio.create_task(cleanup_inactive_sessions())
+    yield
+    cleanup_task.cancel()
+    # 关闭所有仍然存活的MCP会话
+    for session_data in list(mcp_sessions.values()):
+        try:
+            await session_data['cleanup']()
+        except Exception as e:
+            logger.error("关闭会话出错: %s", e)
 
-app = Flask(__name__)
-CORS(app)  # 启用跨域请求支持
+app = FastAPI(lifespan=lifespan, default_response_class=ORJSONResponse)
+# 启用跨域请求支持
+app.add_middleware(
+    CORSMiddleware,
+    allow_origins=["*"],
+    allow_credentials=True,
+    allow_methods=["*"],
+    allow_headers=["*"],
+)
 
 # 存储MCP会话
 mcp_sessions = {}
 # 存储SSE会话
 sse_sessions = {}
 
+# 服务器配置文件路径，import时计算一次
+SERVERS_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'mcp_servers.json')
+
+# mcp_servers.json的内存缓存，按文件mtime失效
+_cfg_cache = {'mtime': 0, 'data': None}
+
+
+def _load_servers():
+    """读取mcp_servers.json，文件未变时直接返回缓存（只付一次os.stat的成本）
+
+    Returns:
+        解析后的配置dict；文件不存在时返回None
+    """
+    try:
+        st = os.stat(SERVERS_FILE)
+    except FileNotFoundError:
+        _cfg_cache['mtime'] = 0
+        _cfg_cache['data'] = None
+        return None
+    if st.st_mtime_ns != _cfg_cache['mtime']:
+        with open(SERVERS_FILE, 'rb') as f:
+            _cfg_cache['data'] = orjson.loads(f.read())
+        _cfg_cache['mtime'] = st.st_mtime_ns
+    return _cfg_cache['data']
+
+
+def _invalidate_servers_cache():
+    """写入配置后调用，强制下次读取重新解析"""
+    _cfg_cache['mtime'] = 0
+
+
+def _err(msg, code=500, **extra):
+    """统一构造失败响应，替代各端点里重复的dict拼装"""
+    return ORJSONResponse({'success': False, 'message': msg, **extra}, status_code=code)
+
+
+def _etag_of(payload_bytes):
+    """对响应体计算实体标签（RFC 7232要求带引号），If-None-Match命中时直接返回304"""
+    return f'"{hashlib.blake2b(payload_bytes, digest_size=16).hexdigest()}"'
+
+
+def _save_servers(server_config):
+    """同步写出配置文件，调用方通过asyncio.to_thread执行以免阻塞事件循环"""
+    with open(SERVERS_FILE, 'wb') as f:
+        f.write(orjson.dumps(server_config, option=orjson.OPT_INDENT_2))
+    _invalidate_servers_cache()
+
+
+async def _session_worker(opener, ready, closed):
+    """在同一个任务里进入并退出一个MCP会话的全部异步上下文
+
+    stdio_client/sse_client/ClientSession都基于anyio的cancel scope，
+    必须由进入它们的那个任务退出，否则aclose会抛
+    "Attempted to exit cancel scope in a different task"。所以上下文的
+    enter、等待关闭信号、aclose全部收在这个worker任务内；其它任务只
+    set closed事件并await本任务结束。
+
+    Args:
+        opener: 协程函数，接收AsyncExitStack，进入各层上下文并返回session
+        ready: Future，连接成功时携带session，失败时携带异常
+        closed: Event，置位后worker关闭上下文并退出
+    """
+    exit_stack = AsyncExitStack()
+    try:
+        session = await opener(exit_stack)
+    except Exception as e:
+        try:
+            await exit_stack.aclose()
+        except Exception as close_err:
+            logger.error("会话建立失败后的清理出错: %s", close_err)
+        ready.set_exception(e)
+        return
+    ready.set_result(session)
+    await closed.wait()
+    await exit_stack.aclose()
+
 # 工具类型定义
 class MCPTool:
-    def __init__(self, name, description, input_schema, output_schema=None, id=None, server_id=None):
+    def __init__(self, name, description, input_schema, output_schema=None, tool_id=None, server_id=None):
         self.name = name
         self.description = description
         self.input_schema = input_schema
         self.output_schema = output_schema
-        self.id = id or f"tool-{id(self)}"
+        self.id = tool_id or f"tool-{id(self)}"
         self.server_id = server_id
-    
-    def to_dict(self):
-        return {
+        # 字典形式只构建一次，to_dict在每次get_tools时直接复用
+        self._dict = {
             "id": self.id,
-            "name": self.name,
-            "description": self.description,
-            "inputSchema": self.input_schema,
-            "outputSchema": self.output_schema,
-            "serverId": self.server_id
+            "name": name,
+            "description": description,
+            "inputSchema": input_schema,
+            "outputSchema": output_schema,
+            "serverId": server_id
         }
 
-# 辅助函数：将异步函数包装为同步函数
-def async_to_sync(f):
-    @wraps(f)
-    def wrapper(*args, **kwargs):
-        return asyncio.run(f(*args, **kwargs))
-    return wrapper
+    def to_dict(self):
+        return self._dict
 
-# SSE事件生成器 - 用于向客户端发送事件流
-def sse_event_generator(server_id):
+
+# 请求体模型：由pydantic-core一次性完成解析和校验
+class ConnectRequest(BaseModel):
+    serverId: str
+    command: Optional[str] = None
+    args: List[str] = Field(default_factory=list)
+    env: Dict[str, str] = Field(default_factory=dict)
+
+
+class DisconnectRequest(BaseModel):
+    serverId: str
+
+
+class CallToolRequest(BaseModel):
+    serverId: str
+    toolName: str
+    args: Dict[str, Any] = Field(default_factory=dict)
+
+
+class ConnectSSERequest(BaseModel):
+    serverId: str
+    serverUrl: str
+
+
+class AddServerRequest(BaseModel):
+    server: Dict[str, Any]
+
+
+# SSE心跳间隔（秒）
+SSE_HEARTBEAT_INTERVAL = 15.0
+# 单次刷出的最大事件数与攒批时间窗口
+SSE_BATCH_MAX_EVENTS = 64
+SSE_BATCH_WINDOW = 0.01
+# SSE队列上限与入队超时：防止慢消费者把队列撑到OOM
+SSE_MAX_QUEUE_SIZE = int(os.environ.get('SSE_MAX_QUEUE_SIZE', 1000))
+SSE_QUEUE_TIMEOUT = float(os.environ.get('SSE_QUEUE_TIMEOUT', 5.0))
+
+
+# 终止哨兵：放入队列后对应的SSE generator结束流
+_SSE_CLOSE = object()
+
+
+async def _sse_dispatch(server_id, event, data):
+    """向指定服务器的SSE队列投递事件，慢客户端超时后直接断开"""
+    queue = sse_sessions.get(server_id)
+    if queue is None:
+        return
     try:
-        sse_queue = asyncio.Queue()
-        sse_sessions[server_id] = sse_queue
-        
-        # 发送初始连接事件
-        yield f"event: connected\ndata: {json.dumps({'server_id': server_id})}\n\n"
-        
-        # 持续发送事件
+        await asyncio.wait_for(queue.put({'event': event, 'data': data}),
+                               timeout=SSE_QUEUE_TIMEOUT)
+    except asyncio.TimeoutError:
+        logger.warning("SSE客户端消费过慢，断开: %s", server_id)
+        if sse_sessions.get(server_id) is queue:
+            del sse_sessions[server_id]
+        # 清掉积压并放入终止哨兵，让对应generator真正结束，
+        # 而不是继续挂在一个已注销的队列上发心跳
         while True:
-            # 从队列获取事件（非阻塞）
             try:
-                event_data = sse_queue.get_nowait()
-                yield f"event: {event_data['event']}\ndata: {json.dumps(event_data['data'])}\n\n"
+                queue.get_nowait()
             except asyncio.QueueEmpty:
-                # 如果队列为空，发送心跳以保持连接
+                break
+        queue.put_nowait(_SSE_CLOSE)
+
+# SSE事件生成器 - 用于向客户端发送事件流
+async def sse_event_generator(server_id):
+    sse_queue = asyncio.Queue(maxsize=SSE_MAX_QUEUE_SIZE)
+    sse_sessions[server_id] = sse_queue
+    try:
+        # 发送初始连接事件
+        yield f"event: connected\ndata: {orjson.dumps({'server_id': server_id}).decode()}\n\n"
+
+        # 持续发送事件：空闲时挂起在队列上，不占CPU，事件到达立即推送
+        loop = asyncio.get_running_loop()
+        closing = False
+        while not closing:
+            try:
+                first = await asyncio.wait_for(
+                    sse_queue.get(), timeout=SSE_HEARTBEAT_INTERVAL
+                )
+            except asyncio.TimeoutError:
+                # 超时说明一段时间没有事件，发送心跳以保持连接
                 yield f": heartbeat\n\n"
-            
-            # 休眠一小段时间
-            time.sleep(1)
-    except GeneratorExit:
-        # 当客户端断开连接时清理
-        if server_id in sse_sessions:
+                continue
+
+            if first is _SSE_CLOSE:
+                break
+            batch = [first]
+
+            # 小窗口内攒批：突发的工具调用结果合并成一次写出
+            deadline = loop.time() + SSE_BATCH_WINDOW
+            while len(batch) < SSE_BATCH_MAX_EVENTS and loop.time() < deadline:
+                try:
+                    event_data = sse_queue.get_nowait()
+                except asyncio.QueueEmpty:
+                    break
+                if event_data is _SSE_CLOSE:
+                    # 先把攒到的事件刷出去，再结束流
+                    closing = True
+                    break
+                batch.append(event_data)
+
+            yield "".join(
+                f"event: {event_data['event']}\ndata: {orjson.dumps(event_data['data']).decode()}\n\n"
+                for event_data in batch
+            )
+    finally:
+        # 当客户端断开连接时清理；同一server_id重连会注册新队列，
+        # 只有仍指向本队列时才注销，避免误删新客户端
+        if sse_sessions.get(server_id) is sse_queue:
             del sse_sessions[server_id]
-        logger.info(f"SSE客户端断开连接: {server_id}")
+        logger.info("SSE客户端断开连接: %s", server_id)
 
 # 测试API
-@app.route('/api/test', methods=['GET'])
-def test_api():
-    return jsonify({
+@app.get('/api/test')
+async def test_api():
+    return {
         'success': True,
         'message': '后端服务器正常运行',
         'time': datetime.now().isoformat()
-    })
+    }
 
 # 健康检查
-@app.route('/api/health', methods=['GET'])
-def health_check():
-    return jsonify({
+@app.get('/api/health')
+async def health_check():
+    return {
         'status': 'ok',
         'time': datetime.now().isoformat()
-    }), 200
+    }
 
 # SSE事件流端点
-@app.route('/api/mcp/sse/<server_id>', methods=['GET'])
-def sse_stream(server_id):
-    logger.info(f"建立SSE连接: {server_id}")
-    return Response(
-        stream_with_context(sse_event_generator(server_id)),
-        mimetype="text/event-stream",
+@app.get('/api/mcp/sse/{server_id}')
+async def sse_stream(server_id: str):
+    logger.info("建立SSE连接: %s", server_id)
+    return StreamingResponse(
+        sse_event_generator(server_id),
+        media_type="text/event-stream",
         headers={
             "Cache-Control": "no-cache",
             "X-Accel-Buffering": "no",
@@ -123,68 +303,50 @@ def sse_stream(server_id):
     )
 
 # 连接到MCP服务器(标准STDIO方式)
-@app.route('/api/mcp/connect', methods=['POST'])
-@async_to_sync
-async def connect_mcp_server():
+@app.post('/api/mcp/connect')
+async def connect_mcp_server(req: ConnectRequest):
     try:
-        data = request.json
-        server_id = data.get('serverId')
-        command = data.get('command')
-        args = data.get('args', [])
-        env_vars = data.get('env', {})
-        
-        logger.info(f"连接请求: server_id={server_id}, command={command}, args={args}")
-        
-        # 如果未提供serverId，返回友好错误
-        if not server_id:
-            return jsonify({
-                'success': False,
-                'message': '缺少serverId参数'
-            }), 400
-        
+        server_id = req.serverId
+        command = req.command
+        args = req.args
+        env_vars = req.env
+
+        logger.debug("连接请求: server_id=%s, command=%s, args=%s", server_id, command, args)
+
         # 尝试从配置文件中获取服务器信息
         try:
-            servers_file = os.path.join(os.path.dirname(__file__), 'mcp_servers.json')
-            if os.path.exists(servers_file):
-                with open(servers_file, 'r', encoding='utf-8') as f:
-                    server_config = json.load(f)
-                
+            server_config = await asyncio.to_thread(_load_servers)
+            if server_config:
                 # 查找服务器配置
                 if 'mcpServers' in server_config and server_id in server_config['mcpServers']:
                     server_info = server_config['mcpServers'][server_id]
-                    logger.info(f"从配置中加载服务器信息: {server_id}")
-                    
+                    logger.debug("从配置中加载服务器信息: %s", server_id)
+
                     # 如果是SSE类型，重定向到SSE连接
                     if server_info.get('serverType') == 'sse' or 'url' in server_info:
-                        logger.info(f"服务器 {server_id} 是SSE类型，重定向到SSE连接")
-                        return jsonify({
-                            'success': False,
-                            'message': '此服务器是SSE类型，请使用SSE方式连接',
-                            'shouldUseSSE': True,
-                            'serverUrl': server_info.get('url', '')
-                        }), 400
-                    
+                        logger.info("服务器 %s 是SSE类型，重定向到SSE连接", server_id)
+                        return _err('此服务器是SSE类型，请使用SSE方式连接', 400,
+                                    shouldUseSSE=True,
+                                    serverUrl=server_info.get('url', ''))
+
                     # STDIO类型，使用配置中的命令和参数
                     command = server_info.get('command', command)
                     args = server_info.get('args', args)
                     env_vars = server_info.get('env', env_vars)
-                    logger.info(f"使用配置中的命令和参数: command={command}, args={args}")
+                    logger.debug("使用配置中的命令和参数: command=%s, args=%s", command, args)
         except Exception as e:
-            logger.warning(f"读取服务器配置失败，使用请求中的参数: {str(e)}")
-        
+            logger.warning("读取服务器配置失败，使用请求中的参数: %s", e)
+
         # 如果未提供命令，返回友好错误
         if not command:
-            return jsonify({
-                'success': False,
-                'message': '缺少command参数'
-            }), 400
-        
+            return _err('缺少command参数', 400)
+
         # 如果已有会话，先关闭
         if server_id in mcp_sessions:
-            logger.info(f"关闭现有会话: {server_id}")
+            logger.info("关闭现有会话: %s", server_id)
             await mcp_sessions[server_id]['cleanup']()
-            del mcp_sessions[server_id]
-        
+            mcp_sessions.pop(server_id, None)
+
 
 
         # 创建服务器参数
@@ -193,387 +355,345 @@ async def connect_mcp_server():
             args=args,
             env=env_vars
         )
-        
-        logger.info(f"创建MCP连接: {command} {' '.join(map(str, args))}")
-        
-        # 创建mcp客户端会话清理函数
+
+        logger.info("创建MCP连接: %s %s", command, " ".join(map(str, args)))
+
+        # 会话的异步上下文由专属worker任务持有，handler返回后继续存活
+        loop = asyncio.get_running_loop()
+        ready = loop.create_future()
+        closed = asyncio.Event()
+
+        async def _open(exit_stack):
+            stdio_transport = await exit_stack.enter_async_context(stdio_client(server_params))
+            read_fn, write_fn = stdio_transport
+            # 创建客户端会话
+            return await exit_stack.enter_async_context(ClientSession(read_fn, write_fn))
+
+        worker = asyncio.create_task(_session_worker(_open, ready, closed))
+
+        # 创建mcp客户端会话清理函数：通知worker在它自己的任务里关闭上下文
         async def cleanup():
-            logger.info(f"清理会话: {server_id}")
+            logger.info("清理会话: %s", server_id)
+            closed.set()
             try:
-                if server_id in mcp_sessions:
-                    if mcp_sessions[server_id].get('exit_stack'):
-                        await mcp_sessions[server_id]['exit_stack'].aclose()
-                    del mcp_sessions[server_id]
+                await worker
             except Exception as e:
-                logger.error(f"清理会话出错: {e}")
-        
+                logger.error("清理会话出错: %s", e)
+            finally:
+                if mcp_sessions.get(server_id, {}).get('worker') is worker:
+                    del mcp_sessions[server_id]
+
         try:
-            # 使用正确的异步上下文管理器方式处理stdio_client
-            logger.info(f"尝试创建stdio_client连接...")
-            
-            # 其他类型的服务器连接
-            async with stdio_client(server_params) as stdio_transport:
-                read_fn, write_fn = stdio_transport
-                
-                # 创建客户端会话
-                session = ClientSession(read_fn, write_fn)
-                
-                # 初始化会话
-                logger.info("初始化MCP会话...")
-                await session.initialize()
-                
-                # 获取工具列表
-                logger.info("获取工具列表...")
-                tools_response = await session.list_tools()
-                tools = []
-                
-                if hasattr(tools_response, 'tools'):
-                    # 转换工具到我们需要的格式
-                    for tool in tools_response.tools:
-                        tools.append(MCPTool(
-                            name=tool.name,
-                            description=tool.description or f"Tool: {tool.name}",
-                            input_schema=tool.inputSchema,
-                            output_schema=tool.outputSchema,
-                            server_id=server_id
-                        ))
-                
-                # 存储会话
-                mcp_sessions[server_id] = {
-                    'session': session,
-                    'tools': tools,
-                    'last_activity': datetime.now(),
-                    'cleanup': cleanup,
-                    'exit_stack': None,  # 暂时不使用exit_stack
-                    'transport_type': 'stdio'
-                }
-                
-                logger.info(f"成功连接到MCP服务器，发现{len(tools)}个工具")
-                
-                # 转换工具为字典返回给前端
-                tool_dicts = [tool.to_dict() for tool in tools]
-                
-                return jsonify({
-                    'success': True,
-                    'message': f"成功连接到MCP服务器，找到{len(tools)}个工具",
-                    'tools': tool_dicts,
-                    'transportType': 'stdio',
-                    'serverId': server_id
-                })
-                
+            logger.info("尝试创建stdio_client连接...")
+            session = await ready
+
+            # 初始化会话
+            logger.info("初始化MCP会话...")
+            await session.initialize()
+
+            # 获取工具列表
+            logger.info("获取工具列表...")
+            tools_response = await session.list_tools()
+            tools = []
+
+            if hasattr(tools_response, 'tools'):
+                # 转换工具到我们需要的格式
+                for tool in tools_response.tools:
+                    tools.append(MCPTool(
+                        name=tool.name,
+                        description=tool.description or f"Tool: {tool.name}",
+                        input_schema=tool.inputSchema,
+                        output_schema=tool.outputSchema,
+                        server_id=server_id
+                    ))
+
+            # 转换工具为字典，连同会话一起缓存，get_tools直接复用
+            tool_dicts = [tool.to_dict() for tool in tools]
+
+            # 存储会话
+            mcp_sessions[server_id] = {
+                'session': session,
+                'tools': tools,
+                'tool_dicts': tool_dicts,
+                'tools_etag': _etag_of(orjson.dumps(tool_dicts)),
+                'last_activity': time.monotonic(),
+                'cleanup': cleanup,
+                'worker': worker,
+                'transport_type': 'stdio'
+            }
+
+            logger.info("成功连接到MCP服务器，发现%d个工具", len(tools))
+
+            return {
+                'success': True,
+                'message': f"成功连接到MCP服务器，找到{len(tools)}个工具",
+                'tools': tool_dicts,
+                'transportType': 'stdio',
+                'serverId': server_id
+            }
+
         except Exception as e:
-            logger.error(f"连接MCP服务器时出错: {str(e)}")
+            logger.error("连接MCP服务器时出错: %s", e)
             await cleanup()
-            return jsonify({
-                'success': False,
-                'message': f"连接失败: {str(e)}",
-                'stack': str(e)
-            }), 500
-    
+            return _err(f"连接失败: {e}", stack=str(e))
+
     except Exception as e:
-        logger.error(f"处理连接请求时出错: {str(e)}")
-        return jsonify({
-            'success': False,
-            'message': f"请求处理错误: {str(e)}",
-            'stack': str(e)
-        }), 500
+        logger.error("处理连接请求时出错: %s", e)
+        return _err(f"请求处理错误: {e}", stack=str(e))
 
 # 断开MCP服务器连接
-@app.route('/api/mcp/disconnect', methods=['POST'])
-@async_to_sync
-async def disconnect_mcp_server():
+@app.post('/api/mcp/disconnect')
+async def disconnect_mcp_server(req: DisconnectRequest):
     try:
-        data = request.json
-        server_id = data.get('serverId')
-        
-        logger.info(f"断开连接请求: {server_id}")
-        
+        server_id = req.serverId
+
+        logger.info("断开连接请求: %s", server_id)
+
         if server_id in mcp_sessions:
             await mcp_sessions[server_id]['cleanup']()
-            return jsonify({
+            return {
                 'success': True,
                 'message': '已断开连接'
-            })
+            }
         else:
-            return jsonify({
+            return {
                 'success': False,
                 'message': '服务器未连接'
-            })
-    
+            }
+
     except Exception as e:
-        logger.error(f"断开连接时出错: {str(e)}")
-        return jsonify({
-            'success': False,
-            'message': f"断开连接失败: {str(e)}"
-        }), 500
+        logger.error("断开连接时出错: %s", e)
+        return _err(f"断开连接失败: {e}")
 
 # 获取工具列表
-@app.route('/api/mcp/tools/<server_id>', methods=['GET'])
-def get_tools(server_id):
+@app.get('/api/mcp/tools/{server_id}')
+async def get_tools(server_id: str, request: Request):
     try:
-        logger.info(f"获取工具列表: {server_id}")
-        
+        logger.debug("获取工具列表: %s", server_id)
+
         if server_id not in mcp_sessions:
-            return jsonify({
-                'success': False,
-                'message': '服务器未连接'
-            }), 404
-        
+            return _err('服务器未连接', 404)
+
         # 更新最后活动时间
-        mcp_sessions[server_id]['last_activity'] = datetime.now()
-        
-        # 获取工具
-        tools = mcp_sessions[server_id]['tools']
-        tool_dicts = [tool.to_dict() for tool in tools]
-        
-        return jsonify({
+        session_data = mcp_sessions[server_id]
+        session_data['last_activity'] = time.monotonic()
+
+        # 工具列表在会话存续期间不变，命中ETag时不用重新序列化
+        etag = session_data['tools_etag']
+        if request.headers.get('if-none-match') == etag:
+            return Response(status_code=304, headers={'ETag': etag})
+
+        return ORJSONResponse({
             'success': True,
-            'tools': tool_dicts
-        })
-    
+            'tools': session_data['tool_dicts']
+        }, headers={'ETag': etag})
+
     except Exception as e:
-        logger.error(f"获取工具列表时出错: {str(e)}")
-        return jsonify({
-            'success': False,
-            'message': f"获取工具列表失败: {str(e)}"
-        }), 500
+        logger.error("获取工具列表时出错: %s", e)
+        return _err(f"获取工具列表失败: {e}")
 
 # 调用工具 - 兼容SSE模式
-@app.route('/api/mcp/call-tool', methods=['POST'])
-@async_to_sync
-async def call_tool():
+@app.post('/api/mcp/call-tool')
+async def call_tool(req: CallToolRequest):
     try:
-        data = request.json
-        server_id = data.get('serverId')
-        tool_name = data.get('toolName')
-        args = data.get('args', {})
-        
-        logger.info(f"调用工具: server_id={server_id}, tool={tool_name}, args={args}")
-        
+        server_id = req.serverId
+        tool_name = req.toolName
+        args = req.args
+
+        logger.debug("调用工具: server_id=%s, tool=%s, args=%s", server_id, tool_name, args)
+
         if server_id not in mcp_sessions:
-            return jsonify({
-                'success': False,
-                'message': '服务器未连接'
-            }), 404
-        
+            return _err('服务器未连接', 404)
+
         # 更新最后活动时间
-        mcp_sessions[server_id]['last_activity'] = datetime.now()
-        
+        mcp_sessions[server_id]['last_activity'] = time.monotonic()
+
         # 获取会话
         session = mcp_sessions[server_id]['session']
         transport_type = mcp_sessions[server_id].get('transport_type', 'stdio')
-        
+
         try:
             # 调用工具
-            logger.info(f"执行MCP工具调用: {tool_name} (传输类型: {transport_type})")
+            logger.debug("执行MCP工具调用: %s (传输类型: %s)", tool_name, transport_type)
             result = await session.call_tool(tool_name, args)
-            
+
             # 提取返回内容
             content = result.content if hasattr(result, 'content') else str(result)
-            logger.info(f"工具调用成功: {content[:100]}...")
-            
+            if logger.isEnabledFor(logging.DEBUG):
+                logger.debug("工具调用成功: %s...", content[:100])
+
             # 对于SSE传输，还要通过事件流发送结果
-            if transport_type == 'sse' and server_id in sse_sessions:
-                await sse_sessions[server_id].put({
-                    'event': 'tool_call_complete',
-                    'data': {
-                        'tool': tool_name,
-                        'args': args,
-                        'result': content
-                    }
+            if transport_type == 'sse':
+                await _sse_dispatch(server_id, 'tool_call_complete', {
+                    'tool': tool_name,
+                    'args': args,
+                    'result': content
                 })
-            
-            return jsonify({
+
+            return {
                 'success': True,
                 'content': content
-            })
-        
+            }
+
         except Exception as e:
-            logger.error(f"调用工具失败: {str(e)}")
-            
+            logger.error("调用工具失败: %s", e)
+
             # 对于SSE传输，通过事件流发送错误
-            if transport_type == 'sse' and server_id in sse_sessions:
-                await sse_sessions[server_id].put({
-                    'event': 'tool_call_error',
-                    'data': {
-                        'tool': tool_name,
-                        'args': args,
-                        'error': str(e)
-                    }
+            if transport_type == 'sse':
+                await _sse_dispatch(server_id, 'tool_call_error', {
+                    'tool': tool_name,
+                    'args': args,
+                    'error': str(e)
                 })
-            
-            return jsonify({
-                'success': False,
-                'message': f"调用工具失败: {str(e)}"
-            }), 500
-    
+
+            return _err(f"调用工具失败: {e}")
+
     except Exception as e:
-        logger.error(f"处理工具调用请求时出错: {str(e)}")
-        return jsonify({
-            'success': False,
-            'message': f"处理请求失败: {str(e)}"
-        }), 500
-
-# 清理不活跃的会话
-def cleanup_inactive_sessions():
+        logger.error("处理工具调用请求时出错: %s", e)
+        return _err(f"处理请求失败: {e}")
+
+# 清理不活跃的会话：在主事件循环上周期执行，
+# 这样aclose的是本循环创建的transport，而不是跨循环asyncio.run
+async def cleanup_inactive_sessions():
     while True:
-        try:
-            now = datetime.now()
-            for server_id, session_data in list(mcp_sessions.items()):
-                last_activity = session_data.get('last_activity')
-                if last_activity and (now - last_activity).total_seconds() > 1800:  # 30分钟
-                    logger.info(f"清理不活跃会话: {server_id}")
-                    asyncio.run(session_data['cleanup']())
-        except Exception as e:
-            logger.error(f"清理会话时出错: {str(e)}")
-        
         # 每10分钟检查一次
-        time.sleep(600)
+        await asyncio.sleep(600)
+        now = time.monotonic()
+        for server_id, session_data in list(mcp_sessions.items()):
+            last_activity = session_data.get('last_activity')
+            if last_activity and now - last_activity > 1800:  # 30分钟
+                logger.info("清理不活跃会话: %s", server_id)
+                try:
+                    await session_data['cleanup']()
+                except Exception as e:
+                    # 单个会话清理失败不应放过本轮其余的过期会话
+                    logger.error("清理会话 %s 时出错: %s", server_id, e)
 
 # 连接到MCP服务器(SSE方式)
-@app.route('/api/mcp/connect-sse', methods=['POST'])
-@async_to_sync
-async def connect_mcp_server_sse():
+@app.post('/api/mcp/connect-sse')
+async def connect_mcp_server_sse(req: ConnectSSERequest):
     if not SSE_AVAILABLE:
-        return jsonify({
-            'success': False,
-            'message': 'SSE传输模式不可用，请使用stdio传输'
-        }), 400
-        
+        return _err('SSE传输模式不可用，请使用stdio传输', 400)
+
     try:
-        data = request.json
-        server_id = data.get('serverId')
-        server_url = data.get('serverUrl')
-        
-        logger.info(f"SSE连接请求: server_id={server_id}, url={server_url}")
-        
-        # 基本参数验证
-        if not server_id:
-            return jsonify({
-                'success': False,
-                'message': '缺少serverId参数'
-            }), 400
-            
-        if not server_url:
-            return jsonify({
-                'success': False,
-                'message': '缺少serverUrl参数'
-            }), 400
-        
+        server_id = req.serverId
+        server_url = req.serverUrl
+
+        logger.debug("SSE连接请求: server_id=%s, url=%s", server_id, server_url)
+
         # 如果已有会话，先关闭
         if server_id in mcp_sessions:
-            logger.info(f"关闭现有会话: {server_id}")
+            logger.info("关闭现有会话: %s", server_id)
             await mcp_sessions[server_id]['cleanup']()
-            del mcp_sessions[server_id]
-        
+            mcp_sessions.pop(server_id, None)
+
+        # 与stdio路径相同：上下文由专属worker任务持有，会话跨请求复用
+        loop = asyncio.get_running_loop()
+        ready = loop.create_future()
+        closed = asyncio.Event()
+
+        async def _open(exit_stack):
+            # 创建SSE客户端连接
+            transport = await exit_stack.enter_async_context(sse_client(server_url))
+            return await exit_stack.enter_async_context(ClientSession(*transport))
+
+        worker = asyncio.create_task(_session_worker(_open, ready, closed))
+
         # 创建清理函数
         async def cleanup():
-            logger.info(f"清理SSE会话: {server_id}")
+            logger.info("清理SSE会话: %s", server_id)
+            closed.set()
             try:
-                if server_id in mcp_sessions:
-                    if 'session' in mcp_sessions[server_id] and hasattr(mcp_sessions[server_id]['session'], 'close'):
-                        await mcp_sessions[server_id]['session'].close()
-                    del mcp_sessions[server_id]
+                await worker
             except Exception as e:
-                logger.error(f"清理SSE会话出错: {e}")
-        
+                logger.error("清理SSE会话出错: %s", e)
+            finally:
+                if mcp_sessions.get(server_id, {}).get('worker') is worker:
+                    del mcp_sessions[server_id]
+
         try:
             # 使用SSE客户端连接到服务器
-            logger.info(f"尝试创建SSE客户端连接到: {server_url}")
-            
-            # 创建异步上下文管理器堆栈
-            async with AsyncExitStack() as exit_stack:
-                # 创建SSE客户端连接
-                transport = await exit_stack.enter_async_context(sse_client(server_url))
-                session = await exit_stack.enter_async_context(ClientSession(transport))
-                
-                try:
-                    # 获取可用工具
-                    tools = []
-                    tools_list = await session.list_tools()
-                    
-                    for tool in tools_list:
-                        tools.append(MCPTool(
-                            name=tool.name,
-                            description=tool.description,
-                            input_schema=tool.input_schema,
-                            output_schema=tool.output_schema,
-                            server_id=server_id
-                        ))
-                    
-                    # 存储会话
-                    mcp_sessions[server_id] = {
-                        'session': session,
-                        'tools': tools,
-                        'last_activity': datetime.now(),
-                        'cleanup': cleanup,
-                        'transport_type': 'sse',
-                        'exit_stack': exit_stack
-                    }
-                    
-                    # 转换工具为字典返回给前端
-                    tool_dicts = [tool.to_dict() for tool in tools]
-                    
-                    return jsonify({
-                        'success': True,
-                        'message': '成功连接到SSE服务器',
-                        'tools': tool_dicts
-                    })
-                    
-                except Exception as session_error:
-                    logger.error(f"SSE会话初始化失败: {str(session_error)}")
-                    raise
-            
+            logger.info("尝试创建SSE客户端连接到: %s", server_url)
+            session = await ready
+
+            # 初始化会话
+            await session.initialize()
+
+            # 获取可用工具
+            tools = []
+            tools_response = await session.list_tools()
+
+            if hasattr(tools_response, 'tools'):
+                for tool in tools_response.tools:
+                    tools.append(MCPTool(
+                        name=tool.name,
+                        description=tool.description or f"Tool: {tool.name}",
+                        input_schema=tool.inputSchema,
+                        output_schema=tool.outputSchema,
+                        server_id=server_id
+                    ))
+
+            # 转换工具为字典，连同会话一起缓存，get_tools直接复用
+            tool_dicts = [tool.to_dict() for tool in tools]
+
+            # 存储会话
+            mcp_sessions[server_id] = {
+                'session': session,
+                'tools': tools,
+                'tool_dicts': tool_dicts,
+                'tools_etag': _etag_of(orjson.dumps(tool_dicts)),
+                'last_activity': time.monotonic(),
+                'cleanup': cleanup,
+                'transport_type': 'sse',
+                'worker': worker
+            }
+
+            return {
+                'success': True,
+                'message': '成功连接到SSE服务器',
+                'tools': tool_dicts
+            }
+
         except Exception as e:
-            logger.error(f"SSE连接MCP服务器时出错: {str(e)}")
+            logger.error("SSE连接MCP服务器时出错: %s", e)
             # 确保清理任何可能的部分连接
             await cleanup()
-            return jsonify({
-                'success': False,
-                'message': f"连接SSE服务器失败: {str(e)}"
-            }), 500
-    
+            return _err(f"连接SSE服务器失败: {e}")
+
     except Exception as e:
-        logger.error(f"处理SSE连接请求时出错: {str(e)}")
-        return jsonify({
-            'success': False,
-            'message': f"SSE请求处理错误: {str(e)}",
-            'stack': str(e)
-        }), 500
+        logger.error("处理SSE连接请求时出错: %s", e)
+        return _err(f"SSE请求处理错误: {e}", stack=str(e))
 
 # 获取MCP服务器列表
-@app.route('/api/mcp/servers', methods=['GET'])
-def get_mcp_servers():
+@app.get('/api/mcp/servers')
+async def get_mcp_servers(request: Request):
     try:
-        servers_file = os.path.join(os.path.dirname(__file__), 'mcp_servers.json')
-        
-        if not os.path.exists(servers_file):
-            return jsonify({
+        server_config = await asyncio.to_thread(_load_servers)
+
+        if server_config is None:
+            return {
                 'success': True,
                 'servers': []
-            })
-        
-        with open(servers_file, 'r', encoding='utf-8') as f:
-            server_config = json.load(f)
-        
+            }
+
         if 'mcpServers' not in server_config:
-            return jsonify({
+            return {
                 'success': True,
                 'servers': []
-            })
-        
+            }
+
         servers = []
-        
+
         for server_id, server_info in server_config['mcpServers'].items():
             server_data = {
                 'id': server_id,
                 'name': server_info.get('name', server_id)
             }
-            
+
             # 添加描述（如果有）
             if 'description' in server_info:
                 server_data['description'] = server_info['description']
-            
+
             # 确定服务器类型
             if 'serverType' in server_info and server_info['serverType'] == 'sse':
                 server_data['type'] = 'sse'
@@ -583,171 +703,136 @@ def get_mcp_servers():
                 server_data['command'] = server_info.get('command', '')
                 server_data['args'] = server_info.get('args', [])
                 server_data['env'] = server_info.get('env', {})
-            
+
             servers.append(server_data)
-        
-        logger.info(f"返回服务器列表: {len(servers)}个")
-        
-        return jsonify({
-            'success': True,
-            'servers': servers
-        })
-    
+
+        logger.debug("返回服务器列表: %d个", len(servers))
+
+        # 配置很少变化，浏览器轮询时命中ETag直接304，不重复传输
+        body = orjson.dumps({'success': True, 'servers': servers})
+        etag = _etag_of(body)
+        if request.headers.get('if-none-match') == etag:
+            return Response(status_code=304, headers={'ETag': etag})
+
+        return Response(content=body, media_type='application/json',
+                        headers={'ETag': etag})
+
     except Exception as e:
-        logger.error(f"获取MCP服务器列表失败: {str(e)}")
-        return jsonify({
-            'success': False,
-            'message': f"获取服务器列表失败: {str(e)}"
-        }), 500
+        logger.error("获取MCP服务器列表失败: %s", e)
+        return _err(f"获取服务器列表失败: {e}")
 
 # 添加或更新MCP服务器配置
-@app.route('/api/mcp/servers', methods=['POST'])
-def add_mcp_server():
+@app.post('/api/mcp/servers')
+async def add_mcp_server(req: AddServerRequest):
     try:
-        data = request.json
-        new_server = data.get('server')
-        
-        logger.info(f"添加/更新服务器请求: {json.dumps(data)}")
-        
-        if not new_server or not new_server.get('id'):
-            return jsonify({
-                'success': False,
-                'message': '缺少服务器ID'
-            }), 400
-        
+        # server内部结构松散（stdio/sse字段不同），保留字典形式做逐项校验
+        new_server = req.server
+
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("添加/更新服务器请求: %s", orjson.dumps(new_server).decode())
+
+        if not new_server.get('id'):
+            return _err('缺少服务器ID', 400)
+
         # 读取现有服务器配置
-        servers_file = os.path.join(os.path.dirname(__file__), 'mcp_servers.json')
-        
-        if os.path.exists(servers_file):
-            with open(servers_file, 'r', encoding='utf-8') as f:
-                server_config = json.load(f)
-        else:
+        server_config = await asyncio.to_thread(_load_servers)
+        if server_config is None:
             server_config = {'mcpServers': {}}
-        
+
         # 确保mcpServers键存在
         if 'mcpServers' not in server_config:
             server_config['mcpServers'] = {}
-        
+
         # 准备服务器配置
         server_id = new_server.get('id')
-        
+
         # 准备Cursor风格的配置对象
         server_config_obj = {}
-        
+
         # 添加常见元数据
         if 'name' in new_server:
             server_config_obj['name'] = new_server.get('name')
         if 'description' in new_server:
             server_config_obj['description'] = new_server.get('description')
-        
+
         # 根据类型设置服务器配置
         server_type = new_server.get('type', 'stdio')
-        logger.info(f"服务器类型: {server_type}")
-        
+        logger.debug("服务器类型: %s", server_type)
+
         if server_type == 'sse' or 'serverType' in new_server:
             # SSE类型服务器
             server_config_obj['serverType'] = 'sse'
-            
+
             # 检查URL
             if 'url' not in new_server:
-                return jsonify({
-                    'success': False,
-                    'message': 'SSE服务器缺少URL'
-                }), 400
-            
+                return _err('SSE服务器缺少URL', 400)
+
             server_config_obj['url'] = new_server.get('url')
-            logger.info(f"添加SSE服务器: {server_id}, URL: {server_config_obj['url']}")
+            logger.info("添加SSE服务器: %s, URL: %s", server_id, server_config_obj['url'])
         else:
             # STDIO类型服务器
             if 'command' not in new_server:
-                return jsonify({
-                    'success': False,
-                    'message': 'STDIO服务器缺少command'
-                }), 400
-            
+                return _err('STDIO服务器缺少command', 400)
+
             server_config_obj['command'] = new_server.get('command')
-            
+
             # 处理参数
             args = new_server.get('args', [])
             if not isinstance(args, list):
                 args = [args] if args else []
-            
+
             server_config_obj['args'] = args
             server_config_obj['env'] = new_server.get('env', {})
-            logger.info(f"添加STDIO服务器: {server_id}, 命令: {server_config_obj['command']}, 参数: {args}")
-        
+            logger.info("添加STDIO服务器: %s, 命令: %s, 参数: %s", server_id, server_config_obj['command'], args)
+
         # 更新配置
         server_config['mcpServers'][server_id] = server_config_obj
-        
-        # 保存到文件
-        with open(servers_file, 'w', encoding='utf-8') as f:
-            json.dump(server_config, f, indent=2, ensure_ascii=False)
-        
-        logger.info(f"服务器配置已保存: {server_id}")
-        
-        return jsonify({
+
+        # 保存到文件（线程池中执行，不阻塞事件循环）
+        await asyncio.to_thread(_save_servers, server_config)
+
+        logger.info("服务器配置已保存: %s", server_id)
+
+        return {
             'success': True,
             'message': '服务器配置已保存'
-        })
-    
+        }
+
     except Exception as e:
-        logger.error(f"添加/更新服务器配置失败: {str(e)}")
-        return jsonify({
-            'success': False,
-            'message': f"服务器配置保存失败: {str(e)}"
-        }), 500
+        logger.error("添加/更新服务器配置失败: %s", e)
+        return _err(f"服务器配置保存失败: {e}")
 
 # 删除MCP服务器配置
-@app.route('/api/mcp/servers/<server_id>', methods=['DELETE'])
-def delete_mcp_server(server_id):
+@app.delete('/api/mcp/servers/{server_id}')
+async def delete_mcp_server(server_id: str):
     try:
         # 读取现有服务器配置
-        servers_file = os.path.join(os.path.dirname(__file__), 'mcp_servers.json')
-        
-        if not os.path.exists(servers_file):
-            return jsonify({
-                'success': False,
-                'message': '服务器配置文件不存在'
-            }), 404
-        
-        with open(servers_file, 'r', encoding='utf-8') as f:
-            server_config = json.load(f)
-        
+        server_config = await asyncio.to_thread(_load_servers)
+        if server_config is None:
+            return _err('服务器配置文件不存在', 404)
+
         # 检查服务器是否存在
         if 'mcpServers' not in server_config or server_id not in server_config['mcpServers']:
-            return jsonify({
-                'success': False,
-                'message': f"未找到服务器: {server_id}"
-            }), 404
-        
+            return _err(f"未找到服务器: {server_id}", 404)
+
         # 删除服务器
         del server_config['mcpServers'][server_id]
-        
-        # 保存配置
-        with open(servers_file, 'w', encoding='utf-8') as f:
-            json.dump(server_config, f, ensure_ascii=False, indent=2)
-        
-        return jsonify({
+
+        # 保存配置（线程池中执行，不阻塞事件循环）
+        await asyncio.to_thread(_save_servers, server_config)
+
+        return {
             'success': True,
             'message': f"服务器 {server_id} 已删除"
-        })
-    
+        }
+
     except Exception as e:
-        logger.error(f"删除MCP服务器配置失败: {str(e)}")
-        return jsonify({
-            'success': False,
-            'message': f"删除服务器配置失败: {str(e)}"
-        }), 500
+        logger.error("删除MCP服务器配置失败: %s", e)
+        return _err(f"删除服务器配置失败: {e}")
 
 if __name__ == '__main__':
-    import threading
-    
-    # 启动清理线程
-    cleanup_thread = threading.Thread(target=cleanup_inactive_sessions, daemon=True)
-    cleanup_thread.start()
-    
     # 获取端口，默认3004
     port = int(os.environ.get('PORT', 3004))
-    
-    # 启动Flask应用
-    app.run(host='0.0.0.0', port=port, debug=True) 
\ No newline at end of file
+
+    # 启动ASGI应用，所有请求共享同一个事件循环
+    uvicorn.run(app, host='0.0.0.0', port=port)
@@ -1,4 +1,14 @@
 import uvicorn
 
 if __name__ == "__main__":
-    uvicorn.run("api:app", host="0.0.0.0", port=8008, reload=True) 
\ No newline at end of file
+    # uvloop + httptools 在流式输出路径上比默认的 asyncio + h11 快不少
+    config = uvicorn.Config(
+        "api:app",
+        host="0.0.0.0",
+        port=8008,
+        loop="uvloop",
+        http="httptools",
+        timeout_keep_alive=75,
+        log_level="info",
+    )
+    uvicorn.Server(config).run()
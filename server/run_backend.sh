@@ -11,8 +11,11 @@ fi
 
 # 检查必要的Python库是否安装
 echo "检查并安装必要的Python依赖..."
-pip install flask==2.3.3 flask-cors==4.0.0 mcp==0.2.0 requests==2.31.0
+pip install -r requirements.txt
 
 # 启动后端服务
+# 长连接保活75秒，SSE流不在每次轮询间重建TCP连接；
+# 生产部署建议在前面加一层nginx做TLS+HTTP/2终结，多标签页共享一条连接：
+#   location /api/mcp/sse/ { proxy_http_version 1.1; proxy_buffering off; proxy_set_header Connection ""; }
 echo "启动MCP后端服务器..."
-python3 mcp_backend.py 
\ No newline at end of file
+uvicorn mcp_backend:app --host 0.0.0.0 --port "${PORT:-3004}" --timeout-keep-alive 75